@@ -5,173 +5,487 @@
 import logging
 import datetime
 import random
+import hashlib
+import functools
+import io
 import qrcode
+from qrcode.image.pil import PilImage
 import os
-import pytz
-from flask import Flask, request, make_response, render_template_string, send_from_directory, Markup
+import atexit
+import fcntl
+import threading
+import time
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+from flask import Flask, request, make_response, redirect, send_from_directory, Markup, abort, g
+from werkzeug.security import safe_join
 
-# Logging-Konfiguration
-logging.basicConfig(filename='debug.log', level=logging.DEBUG, 
+# Debugging-Flag
+DEBUG = True
+
+# Logging-Konfiguration, Debug-Meldungen werden nur mit DEBUG geschrieben, im Betrieb nur Warnungen und Fehler
+logging.basicConfig(filename='debug.log', level=logging.DEBUG if DEBUG else logging.WARNING,
                     format='%(asctime)s %(levelname)s: %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger(__name__)
 
-# Debugging-Flag
-DEBUG = True
+# QR-Codes über Nginx (X-Accel-Redirect) statt über Flask ausliefern, siehe adventskalender.nginx.conf
+NGINX_X_ACCEL = False
 
 # Lokale Zeitzone festlegen
-local_timezone = pytz.timezone("Europe/Berlin")
+local_timezone = ZoneInfo("Europe/Berlin")
 
 app = Flask(__name__)
+# Statische Dateien (CSS) dürfen eine Woche im Browser-Cache bleiben, mit Inhalts-Hash verlinkte (statische_url) ein Jahr
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 604800
 
 # Initialisierung
-tuerchen_status = {tag: set() for tag in range(1, 25)}
 max_preise = 15
 gewinn_zeiten = [12, 13, 14, 15, 16, 17, 18, 19, 20, 21]
-tuerchen_farben = ["#FFCCCC", "#CCFFCC", "#CCCCFF", "#FFFFCC", "#CCFFFF", "#FFCCFF", "#FFCC99", "#99CCFF", "#FF9999", "#99FF99", "#9999FF", "#FF9966"] * 2
+tuerchen_farben = ("#FFCCCC", "#CCFFCC", "#CCCCFF", "#FFFFCC", "#CCFFFF", "#FFCCFF", "#FFCC99", "#99CCFF", "#FF9999", "#99FF99", "#9999FF", "#FF9966") * 2
+# Eine CSS-Klasse je Farbe, die Regeln stehen einmal im Kopf der Seite statt als style-Attribut an jedem Türchen
+farb_klassen = {farbe: f"farbe-{nummer}" for nummer, farbe in enumerate(dict.fromkeys(tuerchen_farben), 1)}
+tuerchen_farben_css = Markup(" ".join(f".{klasse} {{ background-color: {farbe}; }}" for farbe, klasse in farb_klassen.items()))
+# (Nummer, Farbklasse) je Türchen, einmal berechnet statt bei jedem Rendern im Template nachzuschlagen
+tuerchen_mit_farben = tuple((tag, farb_klassen[tuerchen_farben[tag - 1]]) for tag in range(1, 25))
+
+# Teilnahmen ("NAME-TAG") im Speicher, damit nicht bei jeder Anfrage teilnehmer.txt gelesen wird.
+# Die Textdateien bleiben maßgeblich: Jeder Gunicorn-Worker liest nur die Zeilen nach,
+# die seit seinem letzten Abgleich (Offset in Bytes) angehängt wurden.
+teilnahmen_set = set()
+teilnahmen_pro_benutzer = {}  # Benutzername -> Menge der geöffneten Türchen
+teilnahmen_offset = 0
+teilnahmen_lock = threading.RLock()
+
+# Anzahl der Zeilen in gewinner.txt, gesamt und je Tag, die Namen der Gewinner und (Name, Tag) je Gewinn
+vergebene_preise_count = 0
+gewinner_pro_tag = {}
+gewinner_set = set()
+gewinne_set = set()
+gewinner_offset = 0
+gewinner_lock = threading.RLock()
+
+# QR-Codes im Hintergrund erzeugen, damit die Gewinnantwort nicht auf die PNG-Kodierung wartet
+qr_executor = ThreadPoolExecutor(max_workers=2)
 
 def get_local_datetime():
-    utc_dt = datetime.datetime.now(pytz.utc)  # aktuelle Zeit in UTC
-    return utc_dt.astimezone(local_timezone)  # konvertiere in lokale Zeitzone
+    return datetime.datetime.now(local_timezone)
+
+def lies_neue_zeilen(dateiname, offset):
+    """
+    Liest die seit offset angehängten, vollständigen Zeilen einer Datei.
+    Ist die Datei kürzer als offset (geleert oder ersetzt), wird von vorne gelesen.
+    Gibt (zeilen, neuer_offset, von_vorne) zurück.
+    """
+    try:
+        groesse = os.path.getsize(dateiname)
+    except FileNotFoundError:
+        return [], 0, offset > 0
+    if groesse == offset:
+        return [], offset, False
+    von_vorne = groesse < offset
+    if von_vorne:
+        offset = 0
+    with open(dateiname, "rb") as file:
+        file.seek(offset)
+        daten = file.read(groesse - offset)
+    ende = daten.rfind(b"\n") + 1  # unvollständige letzte Zeile beim nächsten Mal lesen
+    return daten[:ende].decode("utf-8").splitlines(), offset + ende, von_vorne
+
+def aktualisiere_gewinner():
+    """ Zählt neu angehängte Einträge in gewinner.txt, auch die anderer Worker. """
+    global gewinner_offset, vergebene_preise_count
+    with gewinner_lock:
+        zeilen, gewinner_offset, von_vorne = lies_neue_zeilen("gewinner.txt", gewinner_offset)
+        if von_vorne:
+            vergebene_preise_count = 0
+            gewinner_pro_tag.clear()
+            gewinner_set.clear()
+            gewinne_set.clear()
+        for zeile in zeilen:
+            if not zeile.strip():
+                continue
+            # Jede Zeile ist ein vergebener Preis, auch wenn sie sich nicht zerlegen lässt
+            vergebene_preise_count += 1
+            try:
+                benutzername, tag_text = zeile.rsplit(" - ", 3)[:2]  # "NAME - Tag X - OV L11 - 2023"
+                tag = int(tag_text.split()[1])
+            except (ValueError, IndexError):
+                logger.warning("Unlesbare Zeile in gewinner.txt übersprungen: %r", zeile)
+                continue
+            gewinner_pro_tag[tag] = gewinner_pro_tag.get(tag, 0) + 1
+            gewinner_set.add(benutzername)
+            gewinne_set.add((benutzername, tag))
 
 def anzahl_vergebener_preise():
-    if DEBUG: logging.debug("Überprüfe Anzahl vergebener Preise")
-    if os.path.exists("gewinner.txt"):
-        with open("gewinner.txt", "r") as file:
-            return len(file.readlines())
-    return 0
+    aktualisiere_gewinner()
+    return vergebene_preise_count
 
 def hat_gewonnen(benutzername):
     """ Überprüft, ob der Benutzer bereits gewonnen hat. """
-    if not os.path.exists("gewinner.txt"):
-        return False
-    with open("gewinner.txt", "r") as file:
-        gewinne = file.readlines()
-    return any(benutzername in gewinn for gewinn in gewinne)
+    aktualisiere_gewinner()
+    return benutzername in gewinner_set
 
-def gewinnchance_ermitteln(benutzername, heutiges_datum, max_preise):
+def lade_gewinnplan():
     """
-    Berechnet die Gewinnchance basierend auf dem aktuellen Datum, der maximalen Anzahl der Preise
-    und ob der Benutzer bereits gewonnen hat.
+    Lädt den Gewinnplan aus gewinnplan.txt (Kopfzeile mit den Parametern, dann Zeilen "TAG-STUNDE")
+    oder legt ihn an. Der Plan verteilt max_preise Gewinne zufällig auf die verbleibenden Tage und
+    Gewinnzeiten. Passt die Kopfzeile nicht mehr zu max_preise, gewinn_zeiten und dem Jahr, wird der
+    Plan neu erstellt. Die Datei sorgt dafür, dass alle Worker und Neustarts denselben Plan verwenden.
     """
-    verbleibende_tage = 25 - heutiges_datum.day
-    vergebene_preise = anzahl_vergebener_preise()
-    noch_zu_vergebene_preise = max_preise - vergebene_preise
-
-    if verbleibende_tage <= 0 or noch_zu_vergebene_preise <= 0:
-        return 0
-
-    gewinnchance = noch_zu_vergebene_preise / verbleibende_tage
-
-    # Reduzierte Gewinnchance für Benutzer, die bereits gewonnen haben
-    if hat_gewonnen(benutzername):
-        return gewinnchance * 0.1  # Beispiel: 10% der normalen Gewinnchance
-
-    return gewinnchance
-
-def hat_teilgenommen(benutzername, tag):
-    if not os.path.exists("teilnehmer.txt"):
-        return False
-    with open("teilnehmer.txt", "r") as file:
-        teilnahmen = file.readlines()
-    return f"{benutzername}-{tag}\n" in teilnahmen
+    heute = get_local_datetime().date()
+    kopfzeile = f"# max_preise={max_preise} gewinn_zeiten={','.join(map(str, gewinn_zeiten))} jahr={heute.year}"
+    with open("gewinnplan.lock", "a") as sperre:
+        fcntl.flock(sperre, fcntl.LOCK_EX)  # wird beim Schließen wieder freigegeben
+        try:
+            with open("gewinnplan.txt", encoding="utf-8") as file:
+                zeilen = file.read().splitlines()
+        except FileNotFoundError:
+            zeilen = []
+        if zeilen and zeilen[0] == kopfzeile:
+            eintraege = [zeile for zeile in zeilen[1:] if zeile.strip()]
+        else:
+            if zeilen:
+                logger.warning("gewinnplan.txt passt nicht zu max_preise, gewinn_zeiten oder Jahr, erstelle ihn neu")
+            erster_tag = heute.day if heute.month == 12 else 1
+            moegliche_zeiten = [(tag, stunde) for tag in range(erster_tag, 25) for stunde in gewinn_zeiten]
+            zeiten = random.sample(moegliche_zeiten, min(max_preise, len(moegliche_zeiten)))
+            eintraege = [f"{tag}-{stunde}" for tag, stunde in sorted(zeiten)]
+            # Erst vollständig in eine Temporärdatei schreiben und dann atomar ersetzen,
+            # damit ein Absturz keinen halben Plan hinterlässt
+            with open("gewinnplan.txt.tmp", "w", encoding="utf-8") as file:
+                file.write("".join(f"{zeile}\n" for zeile in [kopfzeile] + eintraege))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace("gewinnplan.txt.tmp", "gewinnplan.txt")
+    plan = {}
+    for eintrag in eintraege:
+        tag, stunde = eintrag.split("-")
+        plan.setdefault(int(tag), []).append(int(stunde))
+    return plan
+
+def faellige_gewinne(tag, stunde):
+    """ Anzahl der Gewinne, die am Tag bis zur angegebenen Stunde laut Plan fällig sind. """
+    return sum(1 for gewinn_stunde in gewinnplan.get(tag, ()) if gewinn_stunde <= stunde)
+
+def aktualisiere_teilnahmen():
+    """ Übernimmt neu angehängte Einträge aus teilnehmer.txt, auch die anderer Worker. """
+    global teilnahmen_offset
+    with teilnahmen_lock:
+        zeilen, teilnahmen_offset, von_vorne = lies_neue_zeilen("teilnehmer.txt", teilnahmen_offset)
+        if von_vorne:
+            teilnahmen_set.clear()
+            teilnahmen_pro_benutzer.clear()
+        for zeile in zeilen:
+            eintrag = zeile.strip()
+            if not eintrag:
+                continue
+            benutzername, _, tag = eintrag.rpartition("-")
+            if not benutzername or not tag.isdigit():
+                logger.warning("Unlesbare Zeile in teilnehmer.txt übersprungen: %r", zeile)
+                continue
+            teilnahmen_set.add(eintrag)
+            teilnahmen_pro_benutzer.setdefault(benutzername, set()).add(int(tag))
+
+def geoeffnete_tuerchen(benutzername):
+    """ Liefert die Türchen, die der Benutzer bereits geöffnet hat. """
+    aktualisiere_teilnahmen()
+    return teilnahmen_pro_benutzer.get(benutzername, frozenset())
 
 def speichere_teilnehmer(benutzername, tag):
-    if DEBUG: logging.debug(f"Speichere Teilnehmer {benutzername} für Tag {tag}")
-    with open("teilnehmer.txt", "a") as file:
-        file.write(f"{benutzername}-{tag}\n")
+    """
+    Trägt die Teilnahme ein, sofern der Benutzer das Türchen noch nicht geöffnet hat, und gibt zurück,
+    ob das geklappt hat. Prüfung und Schreiben laufen unter einer Dateisperre auf teilnehmer.txt,
+    damit ein doppelter Aufruf auf zwei Workern das Türchen nur einmal öffnet.
+    """
+    logger.debug("Speichere Teilnehmer %s für Tag %s", benutzername, tag)
+    with teilnahmen_lock:
+        teilnehmer_datei = sperre_anhang_datei("teilnehmer.txt")
+        try:
+            aktualisiere_teilnahmen()
+            if f"{benutzername}-{tag}" in teilnahmen_set:
+                return False
+            teilnehmer_datei.write(f"{benutzername}-{tag}\n")
+            aktualisiere_teilnahmen()
+        finally:
+            fcntl.flock(teilnehmer_datei, fcntl.LOCK_UN)
+    return True
+
+def speichere_gewinner(benutzername, tag, stunde):
+    """
+    Trägt den Gewinner ein, sofern laut Gewinnplan noch ein Gewinn offen ist, und gibt zurück,
+    ob das geklappt hat. Ein nicht abgeholter Gewinn verfällt nicht, sondern geht an den nächsten
+    Teilnehmer desselben Tages. Prüfung und Schreiben laufen unter einer Dateisperre, damit
+    parallele Worker jeden Gewinn nur einmal vergeben.
+    """
+    with gewinner_lock:
+        gewinner_datei = sperre_anhang_datei("gewinner.txt")
+        try:
+            aktualisiere_gewinner()
+            if (benutzername, tag) in gewinne_set:
+                logger.debug("%s hat an Tag %s bereits gewonnen", benutzername, tag)
+                return False
+            if vergebene_preise_count >= max_preise or gewinner_pro_tag.get(tag, 0) >= faellige_gewinne(tag, stunde):
+                logger.debug("Kein offener Gewinn für %s an Tag %s um %s Uhr", benutzername, tag, stunde)
+                return False
+            logger.debug("Speichere Gewinner %s für Tag %s", benutzername, tag)
+            gewinner_datei.write(f"{benutzername} - Tag {tag} - OV L11 - 2023\n")
+            aktualisiere_gewinner()
+        finally:
+            fcntl.flock(gewinner_datei, fcntl.LOCK_UN)
+    return True
+
+def erzeuge_qr_code(tag, benutzername, qr_filename):
+    """ Erzeugt den QR-Code für einen Gewinn und speichert ihn unter qr_codes. """
+    qr_pfad = os.path.join('qr_codes', qr_filename)
+    if os.path.exists(qr_pfad):
+        return  # Inhalt hängt nur von Tag und Name ab, vorhandene Datei ist aktuell
+    try:
+        qr = qrcode.QRCode(
+            version=1,
+            error_correction=qrcode.constants.ERROR_CORRECT_L,
+            box_size=10,
+            border=4,
+        )
+        qr.add_data(f"{tag}-{benutzername}-OV L11-2023")
+        qr.make(fit=True)
+        # PNG über Pillows C-Encoder statt über den reinen Python-Encoder (PyPNG) schreiben
+        img = qr.make_image(image_factory=PilImage, fill_color="black", back_color="white")
+        # Im Speicher kodieren (schwache Kompression reicht für die kleinen Bilder) und in einem
+        # Schritt schreiben; os.replace verhindert, dass eine halb geschriebene Datei ausgeliefert wird
+        puffer = io.BytesIO()
+        img.save(puffer, compress_level=1)
+        # Eigener Name je Prozess und Thread, falls der Hintergrund-Thread und ein Abruf gleichzeitig erzeugen
+        tmp_pfad = f"{qr_pfad}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_pfad, 'wb', buffering=0) as file:
+            file.write(puffer.getvalue())
+        os.replace(tmp_pfad, qr_pfad)
+        logger.debug("QR-Code generiert und gespeichert: %s", qr_filename)
+    except Exception:
+        logger.exception("QR-Code %s konnte nicht erzeugt werden", qr_filename)
+
+# Unter Gunicorn läuft der __main__-Block nicht, daher hier anlegen
+os.makedirs('qr_codes', exist_ok=True)
+
+# Im Anhängemodus geöffnete Dateien dieses Prozesses: Dateiname -> Datei
+anhang_dateien = {}
+
+def oeffne_dateien():
+    """
+    Öffnet teilnehmer.txt und gewinner.txt einmal im Anhängemodus statt bei jedem Eintrag.
+    Zeilengepuffert, damit jeder Eintrag sofort auch für die anderen Worker sichtbar ist.
+    """
+    for dateiname in ("teilnehmer.txt", "gewinner.txt"):
+        anhang_dateien[dateiname] = open(dateiname, "a", encoding="utf-8", buffering=1)
 
-def speichere_gewinner(benutzername, tag):
-    if DEBUG: logging.debug(f"Speichere Gewinner {benutzername} für Tag {tag}")
-    with open("gewinner.txt", "a") as file:
-        file.write(f"{benutzername} - Tag {tag} - OV L11 - 2023\n")
+def anhang_datei(dateiname):
+    """
+    Liefert die offene Datei zum Anhängen. Wurde die Datei inzwischen gelöscht oder ersetzt
+    (z. B. beim Zurücksetzen der Saison), wird sie neu geöffnet; sonst landeten alle weiteren
+    Einträge bis zum Neustart in der alten, nicht mehr verlinkten Datei.
+    """
+    datei = anhang_dateien[dateiname]
+    try:
+        pfad_status = os.stat(dateiname)
+        datei_status = os.fstat(datei.fileno())
+        aktuell = (pfad_status.st_dev, pfad_status.st_ino) == (datei_status.st_dev, datei_status.st_ino)
+    except FileNotFoundError:
+        aktuell = False
+    if not aktuell:
+        logger.warning("%s wurde gelöscht oder ersetzt, öffne die Datei neu", dateiname)
+        datei.close()
+        datei = anhang_dateien[dateiname] = open(dateiname, "a", encoding="utf-8", buffering=1)
+    return datei
+
+def sperre_anhang_datei(dateiname):
+    """
+    Sperrt die Datei per flock für alle Worker und liefert sie zurück. Wird sie ersetzt, während
+    auf die Sperre gewartet wird, gilt die Sperre der alten Datei nicht; dann die neue sperren.
+    """
+    while True:
+        datei = anhang_datei(dateiname)
+        fcntl.flock(datei, fcntl.LOCK_EX)
+        if anhang_datei(dateiname) is datei:
+            return datei
+        # anhang_datei hat die alte Datei geschlossen und damit auch ihre Sperre freigegeben
+
+def oeffne_dateien_nach_fork():
+    """
+    Öffnet die Dateien in einem geforkten Worker neu. Eine flock-Sperre gehört zur geöffneten
+    Datei; geerbte Handles würden sich die Sperre mit Master und allen anderen Workern teilen.
+    """
+    for datei in anhang_dateien.values():
+        datei.close()
+    oeffne_dateien()
+
+def schliesse_dateien():
+    for datei in anhang_dateien.values():
+        datei.close()
+
+oeffne_dateien()
+os.register_at_fork(after_in_child=oeffne_dateien_nach_fork)
+atexit.register(schliesse_dateien)
+
+aktualisiere_teilnahmen()
+aktualisiere_gewinner()
+gewinnplan = lade_gewinnplan()
+
+@app.before_request
+def zeitstempel_setzen():
+    """ Ermittelt Datum und Stunde einmal pro Anfrage. """
+    jetzt = get_local_datetime()
+    g.heute = jetzt.date()
+    g.stunde = jetzt.hour
+
+@functools.lru_cache(maxsize=1024)
+def rendere_startseite(username, heute, verbleibende_preise, geoeffnet):
+    """
+    Rendert die Startseite und liefert (html als bytes, etag). Die Seite hängt nur von den Argumenten ab,
+    daher wird sie pro Benutzer, Tag und Stand der Preise/Türchen nur einmal gerendert.
+    """
+    # Die Türchen werden in fester Reihenfolge ausgeliefert und erst im Browser gemischt,
+    # so bleibt die Seite für HTTP-Caches identisch. Link und Klasse stehen fertig fest, das Template setzt nur ein.
+    tuerchen_reihenfolge = []
+    for num, farb_klasse in tuerchen_mit_farben:
+        if num in geoeffnet or num < heute.day:
+            tuerchen_reihenfolge.append((num, "#", f"tuerchen {farb_klasse} disabled"))
+        else:
+            tuerchen_reihenfolge.append((num, f"/oeffne_tuerchen/{num}", f"tuerchen {farb_klasse}"))
+
+    html = HOME_TEMPLATE.render(username=username, tuerchen=tuerchen_reihenfolge, verbleibende_preise=verbleibende_preise).encode('utf-8')
+    # startseiten_version sorgt dafür, dass nach einem Update mit geändertem Template oder CSS kein 304 mehr kommt
+    etag = hashlib.sha1(repr((startseiten_version, username, heute, verbleibende_preise, sorted(geoeffnet))).encode()).hexdigest()
+    return html, etag
 
 @app.route('/', methods=['GET', 'POST'])
 def startseite():
     username = request.cookies.get('username')
-    if DEBUG: logging.debug(f"Startseite aufgerufen - Username: {username}")
-
-    heute = get_local_datetime().date()
-    if DEBUG: logging.debug(f"Startseite - Heute: {heute}")
-
-    verbleibende_preise = max_preise - anzahl_vergebener_preise()
-
-    tuerchen_status.clear()
-    tuerchen_status.update({tag: set() for tag in range(1, 25)})
-    if username:
-        for tag in range(1, 25):
-            if hat_teilgenommen(username, tag):
-                tuerchen_status[tag].add(username)
-
-    # Zufällige Reihenfolge der Türchen bei jedem Aufruf
-    tuerchen_reihenfolge = random.sample(range(1, 25), 24)
+    logger.debug("Startseite aufgerufen - Username: %s", username)
 
     if request.method == 'POST' and not username:
-        username = request.form['username'].upper()
-        resp = make_response(render_template_string(HOME_PAGE, username=username, tuerchen=tuerchen_reihenfolge, heute=heute, tuerchen_status=tuerchen_status, tuerchen_farben=tuerchen_farben, verbleibende_preise=verbleibende_preise, max_preise=max_preise))
-        resp.set_cookie('username', username, max_age=2592000)
+        # Post/Redirect/Get: nur das Cookie setzen, die Seite liefert das folgende GET aus dem Zwischenspeicher
+        resp = redirect('/', code=303)
+        resp.set_cookie('username', request.form['username'].upper(), max_age=2592000)
         return resp
     else:
-        return render_template_string(HOME_PAGE, username=username, tuerchen=tuerchen_reihenfolge, heute=heute, tuerchen_status=tuerchen_status, tuerchen_farben=tuerchen_farben, verbleibende_preise=verbleibende_preise, max_preise=max_preise)
+        heute = g.heute
+        logger.debug("Startseite - Heute: %s", heute)
+        verbleibende_preise = max_preise - anzahl_vergebener_preise()
+        geoeffnet = frozenset(geoeffnete_tuerchen(username)) if username else frozenset()
+        html, etag = rendere_startseite(username, heute, verbleibende_preise, geoeffnet)
+        resp = make_response(html)
+        resp.set_etag(etag, weak=True)
+        if username:
+            # Browser fragen jedes Mal nach, bekommen bei unverändertem Stand aber nur ein 304
+            resp.cache_control.no_cache = True
+        else:
+            # Die Namenseingabe ist für alle gleich und darf kurz zwischengespeichert werden
+            resp.cache_control.public = True
+            resp.cache_control.max_age = 30
+        resp.vary.add('Cookie')
+        return resp.make_conditional(request)
+
+def meldungsseite(schluessel):
+    """ Liefert die beim Start vorgerenderte Seite zu einer festen Meldung. """
+    return make_response(MELDUNGSSEITEN[schluessel])
 
 @app.route('/oeffne_tuerchen/<int:tag>', methods=['GET'])
 def oeffne_tuerchen(tag):
     benutzername = request.cookies.get('username')
     if not benutzername:
-        return make_response(render_template_string(GENERIC_PAGE, content="Bitte gib zuerst deinen Namen/Rufzeichen auf der Startseite ein."))
+        return meldungsseite('kein_name')
 
-    heute = get_local_datetime().date()
-    if DEBUG: logging.debug(f"Öffne Türchen {tag} aufgerufen - Benutzer: {benutzername}, Datum: {heute}")
+    heute = g.heute
+    logger.debug("Öffne Türchen %s aufgerufen - Benutzer: %s, Datum: %s", tag, benutzername, heute)
 
     if heute.month == 12 and heute.day == tag:
         benutzername = benutzername.upper()
 
-        if hat_teilgenommen(benutzername, tag):
-            if DEBUG: logging.debug(f"{benutzername} hat Türchen {tag} bereits geöffnet")
-            return make_response(render_template_string(GENERIC_PAGE, content="Du hast dieses Türchen heute bereits geöffnet!"))
-
-        speichere_teilnehmer(benutzername, tag)
-        tuerchen_status[tag].add(benutzername)
-
-        vergebene_preise = anzahl_vergebener_preise()
-        gewinnchance = gewinnchance_ermitteln(benutzername, heute, max_preise)
-        if DEBUG: logging.debug(f"Gewinnchance für {benutzername} am Tag {tag}: {gewinnchance}")
-
-        if vergebene_preise < max_preise and get_local_datetime().hour in gewinn_zeiten and random.random() < gewinnchance:
-            speichere_gewinner(benutzername, tag)
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(f"{tag}-{benutzername}-OV L11-2023")
-            qr.make(fit=True)
-            img = qr.make_image(fill_color="black", back_color="white")
-            qr_filename = f"{benutzername}_{tag}.png"  # Pfad korrigiert
-            img.save(os.path.join('qr_codes', qr_filename))  # Speicherort korrigiert
-            if DEBUG: logging.debug(f"QR-Code generiert und gespeichert: {qr_filename}")
+        # Prüfen und Eintragen in einem Schritt, auch über mehrere Worker hinweg
+        if not speichere_teilnehmer(benutzername, tag):
+            logger.debug("%s hat Türchen %s bereits geöffnet", benutzername, tag)
+            return meldungsseite('bereits_geoeffnet')
+
+        # Wer schon gewonnen hat, bekommt einen offenen Gewinn nur mit 10% Wahrscheinlichkeit
+        if g.stunde in gewinn_zeiten and (not hat_gewonnen(benutzername) or random.random() < 0.1) \
+                and speichere_gewinner(benutzername, tag, g.stunde):
+            qr_filename = f"{benutzername}_{tag}.png"
+            qr_executor.submit(erzeuge_qr_code, tag, benutzername, qr_filename)
             content = Markup(f"Glückwunsch! Du hast ein Freigetränk in der Clubstation des OV L11 gewonnen. <a href='/download_qr/{qr_filename}'>Lade deinen QR-Code herunter</a> oder sieh ihn dir <a href='/qr_codes/{qr_filename}'>hier an</a>.")
-            return make_response(render_template_string(GENERIC_PAGE, content=content))
+            return make_response(GENERIC_TEMPLATE.render(content=content))
         else:
-            if DEBUG: logging.debug(f"Kein Gewinn für {benutzername} an Tag {tag}")
-            return make_response(render_template_string(GENERIC_PAGE, content="Du hattest heute leider kein Glück, versuche es morgen noch einmal!"))
+            logger.debug("Kein Gewinn für %s an Tag %s", benutzername, tag)
+            return meldungsseite('kein_glueck')
     else:
-        if DEBUG: logging.debug(f"Türchen {tag} kann heute noch nicht geöffnet werden")
-        return make_response(render_template_string(GENERIC_PAGE, content="Dieses Türchen kann heute noch nicht geöffnet werden."))
+        logger.debug("Türchen %s kann heute noch nicht geöffnet werden", tag)
+        return meldungsseite('noch_nicht')
+
+QR_MAX_AGE = 31536000  # ein Jahr
+
+def erzeuge_fehlenden_qr_code(filename):
+    """
+    Erzeugt einen noch fehlenden QR-Code sofort, wenn er abgerufen wird, bevor der Hintergrund-Thread
+    fertig ist (auch in einem anderen Worker oder über Nginx try_files). Nur für eingetragene Gewinne.
+    """
+    if not filename.endswith('.png') or os.path.exists(os.path.join('qr_codes', filename)):
+        return
+    benutzername, _, tag_text = filename[:-len('.png')].rpartition('_')
+    if not tag_text.isdigit():
+        return
+    aktualisiere_gewinner()
+    if (benutzername, int(tag_text)) in gewinne_set:
+        erzeuge_qr_code(int(tag_text), benutzername, filename)
+
+def sende_qr_code(filename, as_attachment=False):
+    """ Liefert einen QR-Code aus, mit NGINX_X_ACCEL per sendfile direkt über Nginx. """
+    erzeuge_fehlenden_qr_code(filename)
+    if not NGINX_X_ACCEL:
+        # Ein QR-Code ändert sich nach dem Erzeugen nicht mehr
+        return send_from_directory('qr_codes', filename, as_attachment=as_attachment, max_age=QR_MAX_AGE)
+    if safe_join('qr_codes', filename) is None:
+        abort(404)
+    resp = make_response('')
+    resp.mimetype = 'image/png'
+    resp.headers['X-Accel-Redirect'] = f"/internal_qr/{quote(filename)}"
+    if as_attachment:
+        resp.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+    return resp
 
 @app.route('/download_qr/<filename>', methods=['GET'])
 def download_qr(filename):
-    if DEBUG: logging.debug(f"Download-Anfrage für QR-Code: {filename}")
-    return send_from_directory(directory='qr_codes', filename=filename, as_attachment=True)
+    logger.debug("Download-Anfrage für QR-Code: %s", filename)
+    return sende_qr_code(filename, as_attachment=True)
 
 @app.route('/qr_codes/<filename>')
 def qr_code(filename):
-    return send_from_directory('qr_codes', filename)
+    return sende_qr_code(filename)
 
 # Route für das Ausliefern von Event-Graphen hinzufügen
 @app.route('/event_graphen/<filename>')
 def event_graph(filename):
-    return send_from_directory('event_graphen', filename)
+    # Die Statistik wird laufend neu erzeugt: kurz cachen, danach per If-Modified-Since prüfen
+    return send_from_directory('event_graphen', filename, max_age=300, conditional=True)
+
+@app.after_request
+def unveraenderliche_antworten(resp):
+    """ Markiert ausgelieferte QR-Codes und versionierte statische Dateien (?v=...) als unveränderlich, Browser prüfen sie dann nicht erneut. """
+    if resp.status_code == 200:
+        if request.path.startswith(('/qr_codes/', '/download_qr/')):
+            resp.cache_control.immutable = True
+        elif request.path.startswith('/static/') and 'v' in request.args:
+            resp.cache_control.max_age = 31536000
+            resp.cache_control.immutable = True
+    return resp
+
+@functools.lru_cache(maxsize=None)
+def statische_url(dateiname):
+    """ URL einer Datei unter static mit kurzem Inhalts-Hash, geänderte Dateien bekommen so eine neue URL. """
+    with open(os.path.join(app.static_folder, dateiname), 'rb') as file:
+        version = hashlib.sha1(file.read()).hexdigest()[:10]
+    return f"/static/{dateiname}?v={version}"
+
+app.jinja_env.globals['statische_url'] = statische_url
 
 # HTML-Templates mit Header und Footer
 HOME_PAGE = '''
@@ -181,30 +495,8 @@ HOME_PAGE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Adventskalender</title>
-    <style>
-      body { font-family: Arial, sans-serif; }
-      header, footer { padding: 10px; background-color: #f1f1f1; text-align: center; }
-      nav a { margin-right: 15px; }
-      .tuerchen { 
-        display: inline-block;
-        width: 100px;
-        height: 100px;
-        margin: 10px;
-        text-align: center;
-        vertical-align: middle;
-        line-height: 100px;
-        border-radius: 10px;
-        font-size: 20px;
-        font-weight: bold;
-        color: black;
-        text-decoration: none;
-      }
-      .disabled { 
-        filter: grayscale(100%);
-        pointer-events: none;
-        cursor: default;
-      }
-    </style>
+    <link rel="stylesheet" href="{{ statische_url('calendar.css') }}">
+    {% if username %}<style>{{ tuerchen_farben_css }}</style>{% endif %}
   </head>
   <body>
     <header>
@@ -223,13 +515,23 @@ HOME_PAGE = '''
       </form>
     {% else %}
       <p>Willkommen, {{ username }}!</p>
-      <div>
-        {% for num in tuerchen %}
-          <a href="{% if not tuerchen_status[num] and num >= heute.day %}/oeffne_tuerchen/{{ num }}{% else %}#{% endif %}" class="tuerchen{% if tuerchen_status[num] or num < heute.day %} disabled{% endif %}" style="background-color: {{ tuerchen_farben[num-1] }}">
+      <div class="tuerchen-container">
+        {% for num, link, klasse in tuerchen %}
+          <a href="{{ link }}" class="{{ klasse }}">
             {{ num }}
           </a>
         {% endfor %}
       </div>
+      <script>
+        // Türchen zufällig anordnen (Fisher-Yates)
+        const container = document.querySelector('.tuerchen-container');
+        const tuerchen = Array.from(container.children);
+        for (let i = tuerchen.length - 1; i > 0; i--) {
+          const j = Math.floor(Math.random() * (i + 1));
+          [tuerchen[i], tuerchen[j]] = [tuerchen[j], tuerchen[i]];
+        }
+        tuerchen.forEach(element => container.appendChild(element));
+      </script>
     {% endif %}
     <footer>
       <p>&copy; 2023 Erik Schauer, DO1FFE, do1ffe@darc.de</p>
@@ -245,11 +547,7 @@ GENERIC_PAGE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Adventskalender</title>
-    <style>
-      body { font-family: Arial, sans-serif; }
-      header, footer { padding: 10px; background-color: #f1f1f1; text-align: center; }
-      nav a { margin-right: 15px; }
-    </style>
+    <link rel="stylesheet" href="{{ statische_url('calendar.css') }}">
   </head>
   <body>
     <header>
@@ -265,26 +563,75 @@ GENERIC_PAGE = '''
 </html>
 '''
 
+# Templates einmalig beim Start kompilieren statt bei jeder Anfrage
+HOME_TEMPLATE = app.jinja_env.from_string(HOME_PAGE, globals={'max_preise': max_preise, 'tuerchen_farben_css': tuerchen_farben_css})
+# Ändert sich mit Template, Farben oder CSS-Datei und fließt in das ETag der Startseite ein
+startseiten_version = hashlib.sha1((HOME_PAGE + tuerchen_farben_css + statische_url('calendar.css')).encode()).hexdigest()[:10]
+GENERIC_TEMPLATE = app.jinja_env.from_string(GENERIC_PAGE)
+
+# Feste Meldungen, deren Seiten nur einmal gerendert werden
+MELDUNGEN = {
+    'kein_name': "Bitte gib zuerst deinen Namen/Rufzeichen auf der Startseite ein.",
+    'bereits_geoeffnet': "Du hast dieses Türchen heute bereits geöffnet!",
+    'kein_glueck': "Du hattest heute leider kein Glück, versuche es morgen noch einmal!",
+    'noch_nicht': "Dieses Türchen kann heute noch nicht geöffnet werden.",
+}
+MELDUNGSSEITEN = {schluessel: GENERIC_TEMPLATE.render(content=text).encode('utf-8') for schluessel, text in MELDUNGEN.items()}
+
 # Route für die Admin-Seite hinzufügen
+QR_PRO_SEITE = 50
+
+# Zwischenspeicher der Admin-Seite: Dateiname -> ((mtime, Größe), Inhalt)
+datei_cache = {}
+
+def lies_datei(dateiname):
+    """
+    Liest eine Textdatei und hält den Inhalt, bis sich mtime oder Größe ändern.
+    Eine fehlende Datei (z. B. zur Laufzeit gelöscht) liefert einen leeren Text.
+    """
+    try:
+        status = os.stat(dateiname)
+        stand = (status.st_mtime_ns, status.st_size)
+        eintrag = datei_cache.get(dateiname)
+        if eintrag is None or eintrag[0] != stand:
+            # Ungepuffert in einem Stück lesen und erst dann dekodieren
+            with open(dateiname, 'rb', buffering=0) as file:
+                eintrag = (stand, file.read().decode('utf-8'))
+            datei_cache[dateiname] = eintrag
+    except FileNotFoundError:
+        return ""
+    return eintrag[1]
+
+# Sortierte Liste der QR-Codes mit der mtime des Verzeichnisses, zu der sie gelesen wurde
+qr_liste_cache = (None, ())
+
+def qr_dateien():
+    """ Liefert die QR-Code-Dateien sortiert; neu gelesen wird nur, wenn sich das Verzeichnis geändert hat. """
+    global qr_liste_cache
+    stand = os.stat('qr_codes').st_mtime_ns
+    if qr_liste_cache[0] != stand:
+        with os.scandir('qr_codes') as eintraege:
+            namen = tuple(sorted(eintrag.name for eintrag in eintraege if eintrag.is_file() and eintrag.name.endswith('.png')))
+        # Ist die mtime noch frisch, kann im selben Zeitschritt ein weiterer QR-Code hinzukommen, ohne dass
+        # sie sich ändert (.tmp anlegen, dann os.replace). Solche Listen nicht behalten, beim nächsten Aufruf neu lesen.
+        if time.time_ns() - stand < 2_000_000_000:
+            return namen
+        qr_liste_cache = (stand, namen)
+    return qr_liste_cache[1]
+
 @app.route('/admingeheim', methods=['GET'])
 def admin_page():
-    if DEBUG: logging.debug("Admin-Seite aufgerufen")
-    qr_files = os.listdir('qr_codes')
-
-    # Inhalte der Dateien lesen
-    if os.path.exists('teilnehmer.txt'):
-        with open('teilnehmer.txt', 'r') as file:
-            teilnehmer_inhalt = file.read()
-    else:
-        teilnehmer_inhalt = "Keine Teilnehmerdaten vorhanden."
+    logger.debug("Admin-Seite aufgerufen")
+    seite = max(request.args.get('seite', 0, type=int), 0)
+    alle_qr_files = qr_dateien()
+    qr_files = alle_qr_files[seite * QR_PRO_SEITE:(seite + 1) * QR_PRO_SEITE]
+    hat_weitere = len(alle_qr_files) > (seite + 1) * QR_PRO_SEITE
 
-    if os.path.exists('gewinner.txt'):
-        with open('gewinner.txt', 'r') as file:
-            gewinner_inhalt = file.read()
-    else:
-        gewinner_inhalt = "Keine Gewinnerdaten vorhanden."
+    # Inhalte der Dateien lesen, unverändert aus dem Zwischenspeicher
+    teilnehmer_inhalt = lies_datei('teilnehmer.txt') or "Keine Teilnehmerdaten vorhanden."
+    gewinner_inhalt = lies_datei('gewinner.txt') or "Keine Gewinnerdaten vorhanden."
 
-    return render_template_string(ADMIN_PAGE, qr_files=qr_files, teilnehmer_inhalt=teilnehmer_inhalt, gewinner_inhalt=gewinner_inhalt)
+    return make_response(ADMIN_TEMPLATE.render(qr_files=qr_files, seite=seite, hat_weitere=hat_weitere, teilnehmer_inhalt=teilnehmer_inhalt, gewinner_inhalt=gewinner_inhalt))
 
 # HTML-Template für die Admin-Seite aktualisieren
 ADMIN_PAGE = '''
@@ -294,16 +641,7 @@ ADMIN_PAGE = '''
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Admin - Adventskalender</title>
-    <style>
-      body { font-family: Arial, sans-serif; }
-      header, footer { padding: 10px; background-color: #f1f1f1; text-align: center; }
-      nav a { margin-right: 15px; }
-      .qr-image { margin: 10px; }
-      .qr-filename { text-align: center; }
-      .data-section { margin: 20px 0; }
-      .data-title { font-weight: bold; }
-      .data-content { background-color: #f1f1f1; padding: 10px; }
-    </style>
+    <link rel="stylesheet" href="{{ statische_url('admin.css') }}">
   </head>
   <body>
     <header>
@@ -326,6 +664,10 @@ ADMIN_PAGE = '''
         </div>
       {% endfor %}
     </div>
+    <nav>
+      {% if seite > 0 %}<a href="?seite={{ seite - 1 }}">Vorherige Seite</a>{% endif %}
+      {% if hat_weitere %}<a href="?seite={{ seite + 1 }}">Nächste Seite</a>{% endif %}
+    </nav>
     <div class="data-section">
       <h2 class="data-title">Teilnehmer</h2>
       <pre class="data-content">{{ teilnehmer_inhalt }}</pre>
@@ -341,9 +683,10 @@ ADMIN_PAGE = '''
 </html>
 '''
 
-if __name__ == '__main__':
-    if not os.path.exists('qr_codes'):
-        os.makedirs('qr_codes')
+ADMIN_TEMPLATE = app.jinja_env.from_string(ADMIN_PAGE)
 
-    if DEBUG: logging.debug("Starte Flask-App")
+# Nur für die Entwicklung, produktiv über Gunicorn starten:
+#   gunicorn -c gunicorn_conf.py advent:app
+if __name__ == '__main__':
+    logger.debug("Starte Flask-App")
     app.run(host='0.0.0.0', port=8087, debug=DEBUG)
@@ -0,0 +1,18 @@
+# Gunicorn-Konfiguration für den Adventskalender
+# Start: gunicorn -c gunicorn_conf.py advent:app
+
+# Wegen preload_app importiert schon der Master advent.py. Damit Locks und Threads
+# dort gevent-fähig angelegt werden, muss vor dem Import gepatcht werden.
+from gevent import monkey
+monkey.patch_all()
+
+import multiprocessing
+
+# Nur lokal erreichbar, nach außen übernimmt Nginx (siehe adventskalender.nginx.conf)
+bind = "127.0.0.1:8087"
+workers = multiprocessing.cpu_count() * 2 + 1
+worker_class = "gevent"
+worker_connections = 1000
+keepalive = 2
+# App einmal im Master laden (Teilnahmen, Gewinner, Gewinnplan) und an die Worker forken
+preload_app = True